@@ -5,11 +5,20 @@ Paperless Scan Adapter - Monitors Samba scan folder and uploads PDFs to Paperles
 
 import os
 import sys
+import json
+import heapq
+import hashlib
 import time
 import logging
+import threading
+import psutil
 import requests
+from concurrent.futures import Future, ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from requests_toolbelt.multipart.encoder import MultipartEncoder
+from inotify_simple import INotify, flags
 from pathlib import Path
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, Set, Tuple
 
 # Configuration from environment variables
 VALIDATION_RETRY_COUNT = int(os.getenv('VALIDATION_RETRY_COUNT', '5'))
@@ -17,17 +26,93 @@ VALIDATION_RETRY_BASE_WAIT_SECONDS = int(os.getenv('VALIDATION_RETRY_BASE_WAIT_S
 UPLOAD_RETRY_COUNT = int(os.getenv('UPLOAD_RETRY_COUNT', '3'))
 UPLOAD_RETRY_BASE_WAIT_SECONDS = int(os.getenv('UPLOAD_RETRY_BASE_WAIT_SECONDS', '5'))
 SCAN_INTERVAL_SECONDS = int(os.getenv('SCAN_INTERVAL_SECONDS', '5'))
+UPLOAD_CONCURRENCY = int(os.getenv('UPLOAD_CONCURRENCY', '4'))
+LOW_PRIORITY = os.getenv('LOW_PRIORITY', '0') == '1'
 PAPERLESS_API_URL = os.getenv('PAPERLESS_API_URL', 'http://paperless-ngx.paperless-ngx.svc.cluster.local:8000')
 SCAN_FOLDER_PATH = Path(os.getenv('SCAN_FOLDER_PATH', '/mnt/scan/scan'))
 ARCHIVE_FOLDER_PATH = Path(os.getenv('ARCHIVE_FOLDER_PATH', '/mnt/scan/scan/archive'))
 LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
 PAPERLESS_ADMIN_USER = os.getenv('PAPERLESS_ADMIN_USER', 'admin')
 PAPERLESS_ADMIN_PASSWORD = os.getenv('PAPERLESS_ADMIN_PASSWORD', '')
+UPLOADED_HASHES_PATH = Path(os.getenv('UPLOADED_HASHES_PATH', str(ARCHIVE_FOLDER_PATH / '.uploaded_hashes.jsonl')))
+
+# Paperless API endpoints
+PAPERLESS_TOKEN_URL = f"{PAPERLESS_API_URL}/api/token/"
+PAPERLESS_UPLOAD_URL = f"{PAPERLESS_API_URL}/api/documents/post_document/"
+
+# Filesystems on which inotify does not see writes made by other hosts (e.g. the scanner)
+NETWORK_FILESYSTEM_TYPES = {'cifs', 'smb3', 'smbfs', 'nfs', 'nfs4', 'ceph', 'glusterfs', '9p', 'fuse.sshfs'}
 
 # Global retry state to track validation attempts for invalid files
 # Structure: {file_path: {"retry_count": int, "next_retry_time": float}}
 retry_state: Dict[str, Dict] = {}
 
+# Retry state for files whose upload failed, updated by the upload workers
+# Structure: {file_path: {"retry_count": int, "next_retry_time": float, "file_hash": Optional[str]}}
+upload_retry_state: Dict[str, Dict] = {}
+
+# Min-heap of scheduled validation and upload retries, so the loop only revisits files that are due
+# Structure: [(next_retry_time, file_path)], entries not matching the retry state are stale
+retry_heap: List[Tuple[float, str]] = []
+
+# Guards retry_heap and upload_retry_state, which are shared with the upload workers
+retry_lock = threading.Lock()
+
+# Validation results of files waiting for a retry, reused while the file is unchanged
+# Structure: {file_path: (st_size, st_mtime_ns, is_valid)}
+validation_cache: Dict[str, Tuple[int, int, bool]] = {}
+
+# SHA-256 of every uploaded file, appended to UPLOADED_HASHES_PATH to skip duplicate scans
+# Structure: {sha256: task_id}
+uploaded_hashes: Dict[str, str] = {}
+
+# Hashes of files whose upload is queued, running or waiting for a retry, so identical
+# files arriving together are not uploaded twice
+# Structure: {sha256: file_path}
+pending_hashes: Dict[str, str] = {}
+
+# Guards uploaded_hashes and pending_hashes
+uploaded_hashes_lock = threading.Lock()
+
+# Serializes appends to UPLOADED_HASHES_PATH, kept separate so lookups do not wait on the share
+uploaded_hashes_file_lock = threading.Lock()
+
+# Cached Paperless API token, reused across uploads until Paperless rejects it
+cached_token: Optional[str] = None
+token_lock = threading.Lock()
+
+# Block size used to read request bodies from the multipart encoder into the socket
+UPLOAD_BLOCKSIZE = 1024 * 1024
+
+
+class UploadHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter whose connections send request bodies in large blocks.
+
+    urllib3 streams file-like bodies in 16 KiB reads by default, which costs a
+    read and a send call per block for multi-megabyte scans.
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs.setdefault('blocksize', UPLOAD_BLOCKSIZE)
+        super().init_poolmanager(*args, **kwargs)
+
+
+# Shared HTTP session so auth and uploads reuse pooled keep-alive connections
+SESSION = requests.Session()
+SESSION.mount('http://', UploadHTTPAdapter(pool_connections=8, pool_maxsize=max(8, UPLOAD_CONCURRENCY), max_retries=0))
+SESSION.mount('https://', UploadHTTPAdapter(pool_connections=8, pool_maxsize=max(8, UPLOAD_CONCURRENCY), max_retries=0))
+SESSION.headers['Connection'] = 'keep-alive'
+
+# Worker pool for uploads, so files of a batch scan are uploaded concurrently
+EXECUTOR = ThreadPoolExecutor(max_workers=UPLOAD_CONCURRENCY, thread_name_prefix='upload')
+
+# Limits queued uploads to the pool size; the scan loop blocks until a slot frees up
+upload_slots = threading.BoundedSemaphore(UPLOAD_CONCURRENCY)
+
+# Files currently handed to the worker pool, skipped by the scan loop until their upload finished
+in_flight_uploads: Set[str] = set()
+in_flight_lock = threading.Lock()
+
 # Setup logging
 logging.basicConfig(
     level=getattr(logging, LOG_LEVEL),
@@ -40,72 +125,149 @@ logger = logging.getLogger(__name__)
 def get_pdf_files(folder: Path) -> List[Path]:
     """Get all PDF files in the folder, sorted by name."""
     try:
-        pdf_files = sorted(folder.glob('*.pdf'))
-        return pdf_files
+        # scandir exposes the entry name and type without an extra stat per file
+        with os.scandir(folder) as entries:
+            names = sorted(entry.name for entry in entries if entry.name.endswith('.pdf') and entry.is_file())
+        return [folder / name for name in names]
     except Exception as e:
         logger.error(f"Error scanning folder {folder}: {e}")
         return []
 
 
-def is_pdf_valid(filepath: Path) -> bool:
-    """Check whether the PDF file ends with an EOF marker.
+def get_filesystem_type(path: Path) -> Optional[str]:
+    """Return the filesystem type of the mount containing path, read from /proc/self/mountinfo."""
+    try:
+        resolved = path.resolve()
+        best_mount_point = None
+        best_fs_type = None
+
+        with open('/proc/self/mountinfo') as f:
+            for line in f:
+                # Format: id parent major:minor root mount_point options [optional...] - fs_type source super_options
+                pre, _, post = line.partition(' - ')
+                mount_point = Path(pre.split()[4].replace('\\040', ' '))
+                fs_type = post.split()[0]
+
+                if mount_point != resolved and mount_point not in resolved.parents:
+                    continue
+
+                # Longest matching mount point wins; later entries shadow earlier ones
+                if best_mount_point is None or len(mount_point.parts) >= len(best_mount_point.parts):
+                    best_mount_point = mount_point
+                    best_fs_type = fs_type
+
+        return best_fs_type
+    except Exception as e:
+        logger.debug(f"Could not determine filesystem type of {path}: {e}")
+        return None
 
-    The PDF spec requires the final non-whitespace characters to be ``%%EOF``. Many
-    scanners use Windows style ``\r\n`` endings or add trailing whitespace, so we
-    trim trailing whitespace before checking for the marker.
-    """
 
-    try:
-        with open(filepath, 'rb') as f:
-            f.seek(0, os.SEEK_END)
-            file_size = f.tell()
+def create_folder_watcher(folder: Path) -> Optional[INotify]:
+    """Create an inotify watch for finished PDF writes, or None if the folder has to be polled."""
+    fs_type = get_filesystem_type(folder)
+    if fs_type in NETWORK_FILESYSTEM_TYPES:
+        logger.info(f"Scan folder is on a network filesystem ({fs_type}), using polling")
+        return None
 
-            if file_size == 0:
-                logger.debug(f"PDF invalid (empty file): {filepath.name}")
-                return False
+    try:
+        inotify = INotify()
+        inotify.add_watch(folder, flags.CLOSE_WRITE | flags.MOVED_TO | flags.DELETE | flags.MOVED_FROM)
+        logger.info("Watching scan folder with inotify")
+        return inotify
+    except OSError as e:
+        logger.warning(f"Could not set up inotify watch, using polling: {e}")
+        return None
 
-            chunk_size = min(1024, file_size)
-            f.seek(-chunk_size, os.SEEK_END)
-            tail = f.read()
 
-        trimmed_tail = tail.rstrip(b"\x00\t\n\r \f")
-        is_valid = trimmed_tail.endswith(b'%%EOF')
+def read_pdf_events(inotify: INotify, folder: Path, timeout_seconds: float) -> List[Path]:
+    """Block until PDF files are written to the folder or the timeout expires.
 
-        if is_valid:
-            logger.debug(f"PDF valid: {filepath.name}")
+    Files deleted or moved away have their retry state dropped right away.
+    """
+    pdf_files = set()
+
+    for event in inotify.read(timeout=int(timeout_seconds * 1000)):
+        if event.mask & flags.Q_OVERFLOW:
+            # Events were dropped by the kernel, fall back to a full scan
+            logger.warning("inotify event queue overflowed, rescanning folder")
+            pdf_files.update(get_pdf_files(folder))
+        elif not event.name.endswith('.pdf'):
+            continue
+        elif event.mask & (flags.DELETE | flags.MOVED_FROM):
+            pdf_files.discard(folder / event.name)
+            forget_file_state(str(folder / event.name))
         else:
-            logger.debug(f"PDF invalid (missing EOF): {filepath.name}")
+            pdf_files.add(folder / event.name)
+
+    return sorted(pdf_files)
 
-        return is_valid
-    except Exception as e:
-        logger.error(f"Error validating PDF {filepath.name}: {e}")
-        return False
 
+def is_pdf_valid(filepath: Path) -> bool:
+    """Check whether the PDF file has a ``%PDF-`` header and ends with an EOF marker.
 
-def retry_validation_with_backoff(filepath: Path) -> bool:
-    """Retry validation with exponential backoff."""
-    logger.info(f"Starting validation retry for: {filepath.name}")
+    The header may be preceded by a few junk bytes, so it is searched for in the
+    first KiB. The PDF spec requires the final non-whitespace characters to be
+    ``%%EOF``. Many scanners use Windows style ``\r\n`` endings or add trailing
+    whitespace, so the last marker may only be followed by whitespace.
 
-    for attempt in range(VALIDATION_RETRY_COUNT):
-        if is_pdf_valid(filepath):
-            logger.info(f"PDF became valid after {attempt + 1} attempts: {filepath.name}")
-            return True
+    Results are cached by size and mtime, so a file waiting for a retry is only
+    read again once the scanner has written to it.
+    """
+
+    try:
+        file_key = str(filepath)
+        stat = filepath.stat()
+
+        cached = validation_cache.get(file_key)
+        if cached is not None and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+            logger.debug(f"PDF unchanged since last validation: {filepath.name}")
+            return cached[2]
+
+        if stat.st_size == 0:
+            logger.debug(f"PDF invalid (empty file): {filepath.name}")
+            is_valid = False
+        else:
+            with open(filepath, 'rb') as f:
+                head = f.read(1024)
+
+                if b'%PDF-' not in head:
+                    tail = None
+                else:
+                    # Take the size from the open file, the scanner may have rewritten it since the stat
+                    f.seek(0, os.SEEK_END)
+                    file_size = f.tell()
+
+                    if file_size <= len(head):
+                        tail = head[:file_size]
+                    else:
+                        f.seek(-min(1024, file_size), os.SEEK_END)
+                        tail = f.read()
+
+            if tail is None:
+                logger.debug(f"PDF invalid (missing header): {filepath.name}")
+                is_valid = False
+            else:
+                # translate() with a delete table leaves nothing if only whitespace follows the marker
+                eof_index = tail.rfind(b'%%EOF')
+                is_valid = eof_index != -1 and not tail[eof_index + 5:].translate(None, b"\x00\t\n\r \f")
 
-        if attempt < VALIDATION_RETRY_COUNT - 1:
-            wait_time = VALIDATION_RETRY_BASE_WAIT_SECONDS * (2 ** attempt)
-            logger.info(f"Validation retry {attempt + 1}/{VALIDATION_RETRY_COUNT} failed, waiting {wait_time}s")
-            time.sleep(wait_time)
+                if is_valid:
+                    logger.debug(f"PDF valid: {filepath.name}")
+                else:
+                    logger.debug(f"PDF invalid (missing EOF): {filepath.name}")
 
-    logger.warning(f"PDF validation failed after {VALIDATION_RETRY_COUNT} retries: {filepath.name}")
-    return False
+        validation_cache[file_key] = (stat.st_size, stat.st_mtime_ns, is_valid)
+        return is_valid
+    except Exception as e:
+        logger.error(f"Error validating PDF {filepath.name}: {e}")
+        return False
 
 
 def authenticate_paperless() -> Optional[str]:
     """Authenticate with Paperless API and return token."""
     try:
-        url = f"{PAPERLESS_API_URL}/api/token/"
-        response = requests.post(
-            url,
+        response = SESSION.post(
+            PAPERLESS_TOKEN_URL,
             json={
                 "username": PAPERLESS_ADMIN_USER,
                 "password": PAPERLESS_ADMIN_PASSWORD
@@ -125,62 +287,161 @@ def authenticate_paperless() -> Optional[str]:
         return None
 
 
-def upload_file_to_paperless(filepath: Path, token: str) -> bool:
-    """Upload a single file to Paperless."""
+def get_paperless_token() -> Optional[str]:
+    """Return the cached Paperless token, authenticating if none is cached yet."""
+    global cached_token
+
+    with token_lock:
+        if cached_token is None:
+            cached_token = authenticate_paperless()
+        return cached_token
+
+
+def invalidate_paperless_token(token: str) -> None:
+    """Drop the cached Paperless token if it is still the given rejected token."""
+    global cached_token
+
+    with token_lock:
+        # Another upload may already have replaced the rejected token
+        if cached_token == token:
+            cached_token = None
+
+
+def post_document(filepath: Path, token: str) -> requests.Response:
+    """Send a single file to the Paperless document endpoint.
+
+    The multipart body is streamed from the open file instead of being built in memory.
+    post_document only consumes one ``document`` field per request, so files must not
+    be batched into one body; additional parts would be dropped without an error.
+    """
+    with open(filepath, 'rb') as f:
+        encoder = MultipartEncoder(fields={'document': (filepath.name, f, 'application/pdf')})
+        headers = {
+            'Authorization': f'Token {token}',
+            'Content-Type': encoder.content_type
+        }
+
+        return SESSION.post(
+            PAPERLESS_UPLOAD_URL,
+            data=encoder,
+            headers=headers,
+            timeout=60
+        )
+
+
+def upload_file_to_paperless(filepath: Path) -> Optional[str]:
+    """Upload a single file to Paperless and return the consumption task id, or None on failure."""
     try:
-        url = f"{PAPERLESS_API_URL}/api/documents/post_document/"
+        token = get_paperless_token()
+        if not token:
+            logger.error("Failed to authenticate with Paperless")
+            return None
 
-        with open(filepath, 'rb') as f:
-            files = {'document': (filepath.name, f, 'application/pdf')}
-            headers = {'Authorization': f'Token {token}'}
+        response = post_document(filepath, token)
 
-            response = requests.post(
-                url,
-                files=files,
-                headers=headers,
-                timeout=60
-            )
+        if response.status_code == 401:
+            # Cached token was revoked, authenticate again and retry once
+            logger.info("Paperless rejected cached token, re-authenticating")
+            invalidate_paperless_token(token)
+            token = get_paperless_token()
+            if not token:
+                logger.error("Failed to re-authenticate with Paperless")
+                return None
+
+            response = post_document(filepath, token)
 
         if response.status_code == 200:
             task_id = response.json() if isinstance(response.json(), str) else response.text
             logger.info(f"Upload successful: {filepath.name} (task_id: {task_id})")
-            return True
+            return task_id
         else:
             logger.error(f"Upload failed: {response.status_code} - {response.text}")
-            return False
+            return None
     except Exception as e:
         logger.error(f"Upload error for {filepath.name}: {e}")
-        return False
+        return None
 
 
-def upload_to_paperless_with_retry(filepath: Path) -> bool:
-    """Upload file to Paperless with retry logic."""
-    logger.info(f"Starting upload: {filepath.name}")
+def compute_file_hash(filepath: Path) -> Optional[str]:
+    """Return the SHA-256 hex digest of the file, or None if it cannot be read."""
+    try:
+        with open(filepath, 'rb') as f:
+            return hashlib.file_digest(f, 'sha256').hexdigest()
+    except Exception as e:
+        logger.error(f"Error hashing file {filepath.name}: {e}")
+        return None
 
-    # Authenticate first
-    token = authenticate_paperless()
-    if not token:
-        logger.error("Failed to authenticate with Paperless")
-        return False
 
-    # Try upload with exponential backoff
-    for attempt in range(UPLOAD_RETRY_COUNT):
-        if upload_file_to_paperless(filepath, token):
-            return True
+def load_uploaded_hashes() -> None:
+    """Load the hashes of previously uploaded files from UPLOADED_HASHES_PATH.
 
-        if attempt < UPLOAD_RETRY_COUNT - 1:
-            wait_time = UPLOAD_RETRY_BASE_WAIT_SECONDS * (2 ** attempt)
-            logger.info(f"Upload retry {attempt + 1}/{UPLOAD_RETRY_COUNT} failed, waiting {wait_time}s")
-            time.sleep(wait_time)
+    The file holds one JSON object per line; unreadable lines (e.g. a line cut off
+    by a crash) are skipped.
+    """
+    try:
+        loaded = {}
+        skipped = 0
+
+        with open(UPLOADED_HASHES_PATH) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    loaded[entry["sha256"]] = entry["task_id"]
+                except (ValueError, KeyError, TypeError):
+                    skipped += 1
+
+        with uploaded_hashes_lock:
+            uploaded_hashes.update(loaded)
+        logger.info(f"Loaded {len(loaded)} uploaded file hash(es) from {UPLOADED_HASHES_PATH}")
+        if skipped:
+            logger.warning(f"Skipped {skipped} unreadable line(s) in {UPLOADED_HASHES_PATH}")
+    except FileNotFoundError:
+        logger.debug(f"No uploaded file hashes found at {UPLOADED_HASHES_PATH}")
+    except Exception as e:
+        logger.warning(f"Could not load uploaded file hashes from {UPLOADED_HASHES_PATH}: {e}")
 
-            # Re-authenticate for retry
-            token = authenticate_paperless()
-            if not token:
-                logger.error("Failed to re-authenticate for retry")
-                return False
 
-    logger.error(f"Upload failed after {UPLOAD_RETRY_COUNT} retries: {filepath.name}")
-    return False
+def reserve_file_hash(file_hash: str, file_key: str) -> Optional[str]:
+    """Reserve a file's hash for its upload.
+
+    Returns a description of the earlier upload if identical content was already
+    uploaded or is being uploaded for another file, otherwise None.
+    """
+    with uploaded_hashes_lock:
+        previous_task_id = uploaded_hashes.get(file_hash)
+        if previous_task_id is not None:
+            return f"already uploaded, task_id: {previous_task_id}"
+
+        pending_file_key = pending_hashes.setdefault(file_hash, file_key)
+        if pending_file_key != file_key:
+            return f"upload of {Path(pending_file_key).name} in progress"
+
+    return None
+
+
+def release_file_hash(file_hash: Optional[str], file_key: str) -> None:
+    """Release a hash reserved by a file whose upload was given up."""
+    if not file_hash:
+        return
+
+    with uploaded_hashes_lock:
+        if pending_hashes.get(file_hash) == file_key:
+            del pending_hashes[file_hash]
+
+
+def record_uploaded_hash(file_hash: str, task_id: str) -> None:
+    """Remember an uploaded file's hash and append it to UPLOADED_HASHES_PATH."""
+    with uploaded_hashes_lock:
+        pending_hashes.pop(file_hash, None)
+        uploaded_hashes[file_hash] = task_id
+
+    try:
+        line = json.dumps({"sha256": file_hash, "task_id": task_id}) + "\n"
+        with uploaded_hashes_file_lock:
+            with open(UPLOADED_HASHES_PATH, 'a') as f:
+                f.write(line)
+    except Exception as e:
+        logger.error(f"Error saving uploaded file hashes to {UPLOADED_HASHES_PATH}: {e}")
 
 
 def delete_file(filepath: Path) -> bool:
@@ -194,22 +455,40 @@ def delete_file(filepath: Path) -> bool:
         return False
 
 
+def reserve_archive_destination(filepath: Path) -> Path:
+    """Claim a free file name in the archive folder by exclusively creating a placeholder.
+
+    If the name is taken, a counter suffix is added (``scan_1.pdf``, ``scan_2.pdf``, ...).
+    """
+    counter = 0
+    while True:
+        name = filepath.name if counter == 0 else f"{filepath.stem}_{counter}{filepath.suffix}"
+        destination = ARCHIVE_FOLDER_PATH / name
+
+        try:
+            os.close(os.open(destination, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return destination
+        except FileExistsError:
+            counter += 1
+
+
 def move_to_archive(filepath: Path) -> bool:
     """Move file to archive folder."""
     try:
-        # Ensure archive folder exists
-        ARCHIVE_FOLDER_PATH.mkdir(parents=True, exist_ok=True)
-
-        destination = ARCHIVE_FOLDER_PATH / filepath.name
+        try:
+            destination = reserve_archive_destination(filepath)
+        except FileNotFoundError:
+            # Archive folder was removed while running, recreate it
+            ARCHIVE_FOLDER_PATH.mkdir(parents=True, exist_ok=True)
+            destination = reserve_archive_destination(filepath)
 
-        # If file already exists in archive, add timestamp
-        if destination.exists():
-            timestamp = time.strftime('%Y%m%d_%H%M%S')
-            stem = filepath.stem
-            suffix = filepath.suffix
-            destination = ARCHIVE_FOLDER_PATH / f"{stem}_{timestamp}{suffix}"
+        try:
+            # Replaces the placeholder
+            filepath.rename(destination)
+        except Exception:
+            destination.unlink(missing_ok=True)
+            raise
 
-        filepath.rename(destination)
         logger.info(f"Moved to archive: {filepath.name} -> {destination.name}")
         return True
     except Exception as e:
@@ -217,13 +496,158 @@ def move_to_archive(filepath: Path) -> bool:
         return False
 
 
-def process_pdf_file(filepath: Path) -> bool:
-    """Process a single PDF file. Returns True if file was handled (deleted or archived)."""
-    logger.info(f"Processing: {filepath.name}")
+def schedule_upload_retry(filepath: Path, file_hash: Optional[str]) -> None:
+    """Schedule the next upload attempt with exponential backoff, or archive the file once retries are used up."""
+    file_key = str(filepath)
+
+    with retry_lock:
+        state = upload_retry_state.setdefault(
+            file_key,
+            {"retry_count": 0, "next_retry_time": 0.0, "file_hash": file_hash}
+        )
+        state["retry_count"] += 1
+        retry_count = state["retry_count"]
+
+        if retry_count < UPLOAD_RETRY_COUNT:
+            wait_time = UPLOAD_RETRY_BASE_WAIT_SECONDS * (2 ** (retry_count - 1))
+            state["next_retry_time"] = time.time() + wait_time
+            heapq.heappush(retry_heap, (state["next_retry_time"], file_key))
+        else:
+            del upload_retry_state[file_key]
+
+    if retry_count >= UPLOAD_RETRY_COUNT:
+        release_file_hash(file_hash, file_key)
+
+    if retry_count < UPLOAD_RETRY_COUNT:
+        logger.info(f"Upload retry {retry_count}/{UPLOAD_RETRY_COUNT} failed, will retry in {wait_time}s: {filepath.name}")
+    else:
+        # Upload failed after retries, move to archive
+        logger.error(f"Upload failed after {UPLOAD_RETRY_COUNT} retries: {filepath.name}")
+        logger.warning(f"Archiving file after upload failure: {filepath.name}")
+        move_to_archive(filepath)
+
+
+def handle_upload_result(filepath: Path, file_hash: Optional[str], future: Future) -> None:
+    """Delete the file after a successful upload, or schedule a retry if the upload failed."""
+    try:
+        if future.cancelled():
+            # Shutdown before the upload started, the file is picked up again on the next start
+            return
+
+        task_id = future.result()
+        if task_id:
+            # Upload successful, delete file
+            with retry_lock:
+                upload_retry_state.pop(str(filepath), None)
+            if file_hash:
+                record_uploaded_hash(file_hash, task_id)
+            delete_file(filepath)
+        else:
+            schedule_upload_retry(filepath, file_hash)
+    except Exception as e:
+        logger.error(f"Unexpected upload error for {filepath.name}: {e}", exc_info=True)
+        with retry_lock:
+            upload_retry_state.pop(str(filepath), None)
+        release_file_hash(file_hash, str(filepath))
+        move_to_archive(filepath)
+    finally:
+        # Release only after the retry is scheduled, so the scan loop does not treat the file as new
+        with in_flight_lock:
+            in_flight_uploads.discard(str(filepath))
+        upload_slots.release()
+
+
+def is_upload_in_flight(filepath: Path) -> bool:
+    """Check whether the file is currently queued or being uploaded."""
+    with in_flight_lock:
+        return str(filepath) in in_flight_uploads
+
+
+def submit_upload(filepath: Path, file_hash: Optional[str]) -> None:
+    """Hand a validated file to the upload pool, waiting while all upload slots are busy."""
+    upload_slots.acquire()
+    with in_flight_lock:
+        in_flight_uploads.add(str(filepath))
+
+    logger.info(f"Starting upload: {filepath.name}")
+    future = EXECUTOR.submit(upload_file_to_paperless, filepath)
+    future.add_done_callback(lambda f: handle_upload_result(filepath, file_hash, f))
+
+
+def forget_file_state(file_key: str) -> None:
+    """Drop retry state and cached validation results of a file that left the scan folder."""
+    validation_cache.pop(file_key, None)
+    with retry_lock:
+        upload_state = upload_retry_state.pop(file_key, None)
+    if upload_state is not None:
+        release_file_hash(upload_state["file_hash"], file_key)
+    if retry_state.pop(file_key, None) is not None:
+        logger.debug(f"Removed retry state for deleted file: {file_key}")
+
+
+def pop_due_retries(current_time: float) -> List[Path]:
+    """Pop all scheduled validation and upload retries that are due."""
+    due_files = []
+
+    with retry_lock:
+        while retry_heap and retry_heap[0][0] <= current_time:
+            next_retry_time, file_key = heapq.heappop(retry_heap)
+
+            # Skip entries of files that were handled or rescheduled in the meantime
+            state = retry_state.get(file_key) or upload_retry_state.get(file_key)
+            if state is not None and state["next_retry_time"] == next_retry_time:
+                due_files.append(Path(file_key))
+
+    return due_files
+
 
+def seconds_until_next_retry() -> float:
+    """Return the time until the next scheduled retry, at most the scan interval.
+
+    Upload workers can schedule retries while the loop is waiting, so the wait is
+    capped at the scan interval to pick those up.
+    """
+    with retry_lock:
+        if retry_heap:
+            return min(SCAN_INTERVAL_SECONDS, max(0.0, retry_heap[0][0] - time.time()))
+    return SCAN_INTERVAL_SECONDS
+
+
+def process_pdf_file(filepath: Path) -> bool:
+    """Process a single PDF file. Returns True if file was handled (queued for upload or deleted)."""
     file_key = str(filepath)
+
+    # Check if file still exists (might have been deleted/moved)
+    if not filepath.exists():
+        forget_file_state(file_key)
+        return False
+
+    logger.info(f"Processing: {filepath.name}")
     current_time = time.time()
 
+    # Files with a failed upload were already validated and only wait for their next attempt
+    with retry_lock:
+        upload_state = upload_retry_state.get(file_key)
+
+    if upload_state is not None:
+        if current_time < upload_state["next_retry_time"]:
+            wait_remaining = int(upload_state["next_retry_time"] - current_time)
+            logger.debug(f"File in upload retry waiting period ({wait_remaining}s remaining): {filepath.name}")
+            return False  # Non-blocking: continue to next file
+
+        file_hash = upload_state["file_hash"]
+        if file_hash:
+            duplicate_of = reserve_file_hash(file_hash, file_key)
+            if duplicate_of is not None:
+                logger.info(f"Identical file {duplicate_of}, archiving: {filepath.name}")
+                with retry_lock:
+                    upload_retry_state.pop(file_key, None)
+                move_to_archive(filepath)
+                return True
+
+        submit_upload(filepath, file_hash)
+        return True
+
     # Check if PDF is valid
     if not is_pdf_valid(filepath):
         # Initialize retry state for this file if not exists
@@ -245,6 +669,7 @@ def process_pdf_file(filepath: Path) -> bool:
                 logger.warning(f"File exceeded {VALIDATION_RETRY_COUNT} validation retries, deleting: {filepath.name}")
                 delete_file(filepath)
                 del retry_state[file_key]
+                validation_cache.pop(file_key, None)
                 return True
 
             # Attempt validation
@@ -261,6 +686,8 @@ def process_pdf_file(filepath: Path) -> bool:
                 next_retry = current_time + wait_time
                 state["retry_count"] = retry_count + 1
                 state["next_retry_time"] = next_retry
+                with retry_lock:
+                    heapq.heappush(retry_heap, (next_retry, file_key))
 
                 logger.info(f"File still invalid, will retry in {wait_time}s (attempt {retry_count + 1}/{VALIDATION_RETRY_COUNT}): {filepath.name}")
                 return False  # Skip for now, will retry later
@@ -274,17 +701,39 @@ def process_pdf_file(filepath: Path) -> bool:
     # Clear retry state if exists
     if file_key in retry_state:
         del retry_state[file_key]
+    validation_cache.pop(file_key, None)
+
+    # Skip files whose exact content was or is being uploaded (e.g. a scan sent twice)
+    file_hash = compute_file_hash(filepath)
+    if file_hash:
+        duplicate_of = reserve_file_hash(file_hash, file_key)
+        if duplicate_of is not None:
+            logger.info(f"Identical file {duplicate_of}, archiving: {filepath.name}")
+            move_to_archive(filepath)
+            return True
 
-    # Attempt upload
-    if upload_to_paperless_with_retry(filepath):
-        # Upload successful, delete file
-        delete_file(filepath)
-        return True
-    else:
-        # Upload failed after retries, move to archive
-        logger.warning(f"Archiving file after upload failure: {filepath.name}")
-        move_to_archive(filepath)
-        return True
+    # Queue upload, the file is deleted or archived once it finished
+    submit_upload(filepath, file_hash)
+    return True
+
+
+def lower_process_priority() -> None:
+    """Lower CPU and I/O scheduling priority so the scanner writing to the share takes precedence.
+
+    Must run before any worker thread is started, as Linux applies both priorities
+    per thread and new threads inherit them.
+    """
+    try:
+        os.nice(10)
+        logger.info("Lowered CPU priority (nice 10)")
+    except Exception as e:
+        logger.warning(f"Could not lower CPU priority: {e}")
+
+    try:
+        psutil.Process().ionice(psutil.IOPRIO_CLASS_IDLE)
+        logger.info("Set I/O priority class to idle")
+    except Exception as e:
+        logger.warning(f"Could not lower I/O priority: {e}")
 
 
 def main():
@@ -298,13 +747,26 @@ def main():
     logger.info(f"Scan interval: {SCAN_INTERVAL_SECONDS}s")
     logger.info(f"Validation retries: {VALIDATION_RETRY_COUNT} (base wait: {VALIDATION_RETRY_BASE_WAIT_SECONDS}s)")
     logger.info(f"Upload retries: {UPLOAD_RETRY_COUNT} (base wait: {UPLOAD_RETRY_BASE_WAIT_SECONDS}s)")
+    logger.info(f"Upload concurrency: {UPLOAD_CONCURRENCY}")
+    logger.info(f"Low priority: {LOW_PRIORITY}")
     logger.info("=" * 60)
 
+    if LOW_PRIORITY:
+        lower_process_priority()
+
     # Verify scan folder exists
     if not SCAN_FOLDER_PATH.exists():
         logger.error(f"Scan folder does not exist: {SCAN_FOLDER_PATH}")
         sys.exit(1)
 
+    # Create archive folder once instead of on every archived file
+    try:
+        ARCHIVE_FOLDER_PATH.mkdir(parents=True, exist_ok=True)
+    except OSError as e:
+        logger.error(f"Could not create archive folder {ARCHIVE_FOLDER_PATH}: {e}")
+
+    load_uploaded_hashes()
+
     # Verify credentials
     if not PAPERLESS_ADMIN_PASSWORD:
         logger.error("PAPERLESS_ADMIN_PASSWORD not set")
@@ -312,48 +774,63 @@ def main():
 
     # Test authentication
     logger.info("Testing Paperless authentication...")
-    token = authenticate_paperless()
+    token = get_paperless_token()
     if not token:
         logger.error("Initial authentication test failed")
         sys.exit(1)
     logger.info("Authentication test successful")
 
     # Main processing loop
+    watcher = create_folder_watcher(SCAN_FOLDER_PATH)
+
+    # Files already present at startup never produce an inotify event
+    pdf_files = get_pdf_files(SCAN_FOLDER_PATH)
+
     while True:
         try:
-            pdf_files = get_pdf_files(SCAN_FOLDER_PATH)
+            due_files = pop_due_retries(time.time())
 
-            # Cleanup retry state for files that no longer exist
-            current_file_keys = {str(f) for f in pdf_files}
-            keys_to_remove = [k for k in retry_state.keys() if k not in current_file_keys]
-            for key in keys_to_remove:
-                del retry_state[key]
-                logger.debug(f"Removed retry state for deleted file: {key}")
+            if watcher is None:
+                pdf_files = get_pdf_files(SCAN_FOLDER_PATH)
+
+            # Files waiting for a retry produce no new events, and due files that were deleted
+            # in the meantime get their state dropped by process_pdf_file
+            pdf_files = sorted(set(pdf_files) | set(due_files))
 
             if pdf_files:
                 logger.info(f"Found {len(pdf_files)} PDF file(s) to process")
 
-                # Process files sequentially
+                # Validate files in order, uploads run concurrently in the worker pool
                 for pdf_file in pdf_files:
-                    # Check if file still exists (might have been deleted/moved)
-                    if not pdf_file.exists():
+                    # Skip files whose upload is still running
+                    if is_upload_in_flight(pdf_file):
                         continue
 
                     process_pdf_file(pdf_file)
             else:
                 logger.debug("No PDF files found")
 
-            # Wait before next scan
-            logger.debug(f"Waiting {SCAN_INTERVAL_SECONDS}s until next scan...")
-            time.sleep(SCAN_INTERVAL_SECONDS)
+            if watcher is None:
+                # Wait before next scan
+                logger.debug(f"Waiting {SCAN_INTERVAL_SECONDS}s until next scan...")
+                time.sleep(SCAN_INTERVAL_SECONDS)
+            else:
+                # Wake up on new files, or when the next validation retry is due
+                timeout = seconds_until_next_retry()
+                logger.debug(f"Waiting up to {timeout:.1f}s for new files...")
+                pdf_files = read_pdf_events(watcher, SCAN_FOLDER_PATH, timeout)
 
         except KeyboardInterrupt:
-            logger.info("Received shutdown signal, exiting...")
+            logger.info("Received shutdown signal, waiting for running uploads...")
+            EXECUTOR.shutdown(wait=True, cancel_futures=True)
             break
         except Exception as e:
             logger.error(f"Unexpected error in main loop: {e}", exc_info=True)
             time.sleep(SCAN_INTERVAL_SECONDS)
 
+            # Rescan instead of repeating the failed list, which would also stop reading inotify events
+            pdf_files = get_pdf_files(SCAN_FOLDER_PATH)
+
 
 if __name__ == '__main__':
     main()